@@ -1,9 +1,11 @@
 import os
+import logging
 from dotenv import load_dotenv, dotenv_values
-from shiny import App, ui, reactive, render
+from shiny import App, ui, reactive, render, run_app
 from openai import AsyncOpenAI
 import asyncio
-import requests
+from metrics import metrics_endpoint
+from pipeline import configure_logging, create_pipeline
 
 # Clear any existing environment variables that might conflict
 if 'OPENAI_API_KEY' in os.environ:
@@ -13,23 +15,16 @@ if 'OPENAI_API_KEY' in os.environ:
 # Load environment variables from .env file
 load_dotenv()
 
+# Leveled logging instead of print debugging; set LOG_LEVEL=DEBUG to include response text
+configure_logging('INFO')
+logger = logging.getLogger(__name__)
+
 # Initialize OpenAI API key
 api_key = os.getenv('OPENAI_API_KEY')
 aclient = AsyncOpenAI(api_key=api_key)
 
-# Function to query the Clinical Tables HPO API
-async def query_hpo_api(term):
-    api_url = f"https://clinicaltables.nlm.nih.gov/api/hpo/v3/search?terms={term}"
-    response = requests.get(api_url)
-    if response.status_code == 200:
-        return response.json()
-    else:
-        response.raise_for_status()
-
-# Function to extract unique terms from the case report
-def extract_terms(case_report):
-    terms = set(case_report.split())  # Using set to get unique terms
-    return list(terms)
+# Shared pipeline: one pooled HPO connection and response cache for every session in this worker
+pipeline = create_pipeline(aclient)
 
 # Define the UI
 app_ui = ui.page_fluid(
@@ -47,6 +42,12 @@ app_ui = ui.page_fluid(
                 document.getElementById('response_header').style.display = 'none';
             }
         });
+        Shiny.addCustomMessageHandler('stream-output', function(text) {
+            if (text) {
+                document.getElementById('response_header').style.display = 'block';
+            }
+            document.getElementById('output_area').textContent = text;
+        });
     """),
     ui.h3("GPT-4 HPO Response:", id="response_header", style="display:none; margin-top: 20px;"),  # Add margin-top for spacing
     ui.output_text_verbatim("output_area"),  # Use output_text_verbatim for displaying the response
@@ -61,110 +62,72 @@ def server(input, output, session):
     error_reactive = reactive.Value("")
     response_header_visible = reactive.Value(False)
 
-    async def call_gpt4_with_retry(refined_prompt, max_retries=3, initial_delay=2):
-        for attempt in range(max_retries):
-            try:
-                response = await asyncio.wait_for(
-                    aclient.chat.completions.create(
-                        model="gpt-4",
-                        messages=[
-                            {"role": "system", "content": "You are a medical expert."},
-                            {"role": "user", "content": refined_prompt}
-                        ],
-                        max_tokens=500,  # Reduced max_tokens for faster response
-                        temperature=0.7,
-                        top_p=1.0,
-                        frequency_penalty=0.0,
-                        presence_penalty=0.0
-                    ),
-                    timeout=30  # Timeout after 30 seconds
-                )
-                return response
-            except Exception as e:
-                if attempt < max_retries - 1:
-                    print(f"Error occurred: {e}. Retrying in {initial_delay} seconds...")
-                    await asyncio.sleep(initial_delay)
-                    initial_delay *= 2
-                else:
-                    raise e
-
-    @reactive.Effect
-    @reactive.event(input.submit)
-    async def process_case_report():
-        case_report = input.case_report()
-        try:
-            log = []
-            log.append("Submitting request to HPO API...")
-            print("Submitting request to HPO API...")
-
-            terms = extract_terms(case_report)
-            hpo_terms_info = []
-
-            for term in terms:
-                hpo_response = await query_hpo_api(term)
-                if hpo_response and len(hpo_response) > 2 and isinstance(hpo_response[3], list):
-                    for item in hpo_response[3]:
-                        if isinstance(item, str):
-                            hpo_terms_info.append(item)
-                        elif isinstance(item, list):
-                            hpo_terms_info.extend(item)
+    async def show_partial_response(text):
+        await session.send_custom_message('stream-output', text)
 
-            # Limiting the number of terms to prevent exceeding the token limit
-            hpo_terms_info = hpo_terms_info[:500]
+    # Incremented on every submit so a superseded run stops updating the page
+    current_run = 0
 
-            # Ensure all items in hpo_terms_info are strings and join them into a single string
-            hpo_terms_info_str = "\n".join(hpo_terms_info)
-            log.append("Received response from HPO API.")
-            print("Received response from HPO API:", hpo_terms_info_str)
+    # Runs in the background so the session stays responsive; returns (result, error)
+    @reactive.extended_task
+    async def process_case_report(case_report, run_id):
+        log = []
 
-            # Limit the case report length to avoid exceeding the context length
-            case_report = case_report[:5000]
+        async def on_text(text):
+            if run_id == current_run:
+                await show_partial_response(text)
 
-            log.append("Submitting request to GPT-4...")
-            print("Submitting request to GPT-4...")
-
-            # Query GPT-4 with additional information
-            refined_prompt = f"Given the following patient case report and related medical terms, list the potential differential diagnoses and broad disease categories:\n\nCase Report:\n{case_report}\n\nRelated Medical Terms:\n{hpo_terms_info_str}"
-            response = await call_gpt4_with_retry(refined_prompt)
-
-            log.append("Received response from GPT-4.")
-            print("Received response from GPT-4.")
+        try:
+            # Cached responses return immediately; identical submissions in flight
+            # (from any session) share one upstream call
+            diagnosis = await pipeline.diagnose(case_report, on_text=on_text, log=log, session_id=session.id)
+            response_content = diagnosis.text
+            if diagnosis.model != pipeline.model:
+                # Make it clear when the answer didn't come from the configured model
+                response_content = (f"[Answered by {diagnosis.model} because {pipeline.model} "
+                                    f"was rate limited.]\n\n{response_content}")
 
-            # Debug: Print the response
-            response_content = response.choices[0].message.content.strip()
             log.append(f"Response content: {response_content}")
-            print("Response content:", response_content)
-
-            result_reactive.set(response_content)
-            error_reactive.set("")  # Clear any previous errors
-            response_header_visible.set(True)  # Show the response header
+            logger.debug("Response content: %s", response_content)
+            return response_content, ""
 
         except asyncio.TimeoutError:
             log.append("Request to GPT-4 timed out.")
-            print("Request to GPT-4 timed out.")
-            error_reactive.set("Error: Request to GPT-4 timed out.")
-            result_reactive.set("\n".join(log))
-            response_header_visible.set(False)  # Hide the response header if there's an error
+            logger.warning("Request to GPT-4 timed out.")
+            return "\n".join(log), "Error: Request to GPT-4 timed out."
 
         except Exception as e:
             log.append(f"An error occurred: {e}")
-            print(f"An error occurred: {e}")
-            error_reactive.set(f"Error: {str(e)}")
-            result_reactive.set("\n".join(log))
-            response_header_visible.set(False)  # Hide the response header if there's an error
+            logger.exception("An error occurred: %s", e)
+            return "\n".join(log), f"Error: {str(e)}"
+
+    @reactive.Effect
+    @reactive.event(input.submit)
+    async def submit_case_report():
+        nonlocal current_run
+        # A new submit supersedes any run still in progress for this session
+        current_run += 1
+        process_case_report.cancel()
+        # Clear the previous response, including partial text streamed straight into the page,
+        # so the next result is always rendered even if it is the same as the last one
+        result_reactive.set("")
+        await show_partial_response("")
+        process_case_report.invoke(input.case_report(), current_run)
+
+    @reactive.Effect
+    def show_case_report_result():
+        result, error = process_case_report.result()
+        result_reactive.set(result)
+        error_reactive.set(error)  # Clear any previous errors on success
+        response_header_visible.set(not error)  # Hide the response header if there's an error
 
     @render.text
     def output_text():
-        # Debug: Print the current result
-        current_result = result_reactive.get()
-        print("output_text called. Current result:", current_result)
-        return current_result
+        return result_reactive.get()
 
     @render.text
     def error_text():
-        current_error = error_reactive.get()
-        print("error_text called. Current error:", current_error)
-        return current_error
+        return error_reactive.get()
 
     @render.text
     def output_area():
@@ -180,7 +143,14 @@ def server(input, output, session):
         await session.send_custom_message('toggle-response-header', response_header_visible.get())
 
 # Create the app
-app = App(app_ui, server)
+shiny_app = App(app_ui, server)
+
+# Serve Prometheus metrics at /metrics alongside the Shiny app
+async def app(scope, receive, send):
+    if scope["type"] == "http" and scope["path"] == "/metrics":
+        await metrics_endpoint(scope, receive, send)
+    else:
+        await shiny_app(scope, receive, send)
 
 if __name__ == "__main__":
-    app.run()
+    run_app(app)
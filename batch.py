@@ -0,0 +1,167 @@
+"""Run a JSONL file of case reports through the HPO + GPT-4 pipeline.
+
+    python batch.py cases.jsonl results.jsonl --concurrency 8 --rpm 500 --tpm 40000
+
+Each input line is a JSON object holding the case report (--text-field) and
+an identifier (--id-field; the line number is used when it is missing).
+Results are appended to the output file as they finish, one JSON object per
+line, so re-running the same command skips records that already succeeded.
+Use "-" to read from stdin or write to stdout (no resuming).
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+from dotenv import load_dotenv
+from openai import AsyncOpenAI
+
+from pipeline import configure_logging, create_pipeline
+from scheduler import RequestScheduler
+
+
+def load_checkpoint(path):
+    # ids already finished without error in a previous run
+    done = set()
+    if path == "-":
+        return done
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # a line cut short by a crash
+                if isinstance(record, dict) and record.get("error") is None and valid_id(record.get("id")):
+                    done.add(record.get("id"))
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def valid_id(record_id):
+    # Ids are used as set keys and written back out, so only plain strings and integers will do
+    return isinstance(record_id, (str, int)) and not isinstance(record_id, bool)
+
+
+def parse_record(line, line_number, args):
+    """Return (record id, case report, error) for one input line; error is None if the record is usable."""
+    try:
+        record = json.loads(line)
+    except json.JSONDecodeError as e:
+        return line_number, None, f"invalid JSON: {e}"
+    if not isinstance(record, dict):
+        return line_number, None, "record is not a JSON object"
+    record_id = record.get(args.id_field, line_number)
+    if not valid_id(record_id):
+        return line_number, None, f"{args.id_field!r} must be a string or an integer"
+    case_report = record.get(args.text_field)
+    if not isinstance(case_report, str) or not case_report.strip():
+        return record_id, None, f"missing or empty {args.text_field!r} field"
+    return record_id, case_report, None
+
+
+def write_result(out, result):
+    out.write(json.dumps(result) + "\n")
+    out.flush()
+
+
+async def read_records(path, queue, args, done, workers, out, stats):
+    f = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    try:
+        line_number = 0
+        while True:
+            # Read off the event loop so a slow stdin doesn't stall the workers
+            line = await asyncio.to_thread(f.readline)
+            if not line:
+                break
+            line_number += 1
+            if not line.strip():
+                continue
+            record_id, case_report, error = parse_record(line, line_number, args)
+            if record_id in done:
+                continue
+            if error is not None:
+                # Report the bad record and carry on with the rest of the batch
+                write_result(out, {"id": record_id, "diagnosis": None, "error": error, "seconds": 0})
+                stats["failed"] += 1
+                continue
+            await queue.put((record_id, case_report))
+    finally:
+        if f is not sys.stdin:
+            f.close()
+        for _ in range(workers):
+            await queue.put(None)
+
+
+async def worker(pipeline, queue, out, stats):
+    while True:
+        item = await queue.get()
+        if item is None:
+            return
+        record_id, case_report = item
+        start = time.perf_counter()
+        result = {"id": record_id}
+        try:
+            diagnosis = await pipeline.diagnose(case_report)
+            result.update(diagnosis=diagnosis.text, error=None, model=diagnosis.model, cached=diagnosis.cached,
+                          prompt_tokens=diagnosis.prompt_tokens, completion_tokens=diagnosis.completion_tokens,
+                          timings=diagnosis.timings)
+            stats["ok"] += 1
+        except Exception as e:
+            result.update(diagnosis=None, error=f"{type(e).__name__}: {e}")
+            stats["failed"] += 1
+        result["seconds"] = round(time.perf_counter() - start, 3)
+        write_result(out, result)
+
+
+async def run(args):
+    load_dotenv()
+    # Log to stderr so results can be written to stdout
+    configure_logging('WARNING')
+    scheduler = RequestScheduler(max_concurrency=args.concurrency, requests_per_minute=args.rpm,
+                                 tokens_per_minute=args.tpm, fallback_model=args.fallback_model)
+    pipeline = create_pipeline(AsyncOpenAI(), stream=False, scheduler=scheduler)
+
+    done = load_checkpoint(args.output)
+    if done:
+        print(f"Resuming: skipping {len(done)} finished records.", file=sys.stderr)
+
+    queue = asyncio.Queue(maxsize=args.concurrency * 2)
+    stats = {"ok": 0, "failed": 0}
+    out = sys.stdout if args.output == "-" else open(args.output, "a", encoding="utf-8")
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(
+            read_records(args.input, queue, args, done, args.concurrency, out, stats),
+            *(worker(pipeline, queue, out, stats) for _ in range(args.concurrency)),
+        )
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        await pipeline.hpo_client.aclose()
+        # Write out cache entries still waiting to go to disk
+        pipeline.hpo_client.cache.close()
+        pipeline.response_cache.close()
+    elapsed = time.perf_counter() - start
+    print(f"Finished {stats['ok']} records ({stats['failed']} failed) in {elapsed:.1f}s.", file=sys.stderr)
+    return 1 if stats["failed"] else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("input", help='input JSONL file, or "-" for stdin')
+    parser.add_argument("output", help='output JSONL file (appended to), or "-" for stdout')
+    parser.add_argument("--text-field", default="case_report", help="field holding the case report")
+    parser.add_argument("--id-field", default="id", help="field holding the record id")
+    parser.add_argument("--concurrency", type=int, default=4, help="case reports processed at once")
+    parser.add_argument("--rpm", type=float, help="GPT-4 requests per minute")
+    parser.add_argument("--tpm", type=float, help="GPT-4 tokens per minute (prompt + max completion)")
+    parser.add_argument("--fallback-model", help="model to use while GPT-4 is rate limited")
+    return asyncio.run(run(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
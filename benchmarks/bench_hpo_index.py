@@ -0,0 +1,104 @@
+"""Compare the offline HPO index with remote per-word search on a sample case report.
+
+Run from the repository root, ideally with the real ontology
+(https://purl.obolibrary.org/obo/hp.obo):
+
+    python benchmarks/bench_hpo_index.py --ontology hp.obo
+
+Without --ontology a synthetic ontology of similar size is generated.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hpo_client import HPOClient  # noqa: E402
+from hpo_index import STOPWORDS, HPOIndex, tokenize  # noqa: E402
+from stub_servers import StubServer, clinical_tables_app  # noqa: E402
+
+SAMPLE_CASE_REPORT = """\
+A 6-year-old boy presented with a chronic cough, recurrent wheezing and failure to thrive.
+His parents reported frequent respiratory infections since infancy, foul-smelling stools,
+and poor weight gain despite a good appetite. On examination he had digital clubbing,
+nasal polyps, and hepatomegaly. Laboratory studies showed hyponatremia, hypochloremia and
+an elevated sweat chloride. Chest imaging revealed bronchiectasis. There was no history
+of seizures, hypotonia, or developmental delay.
+"""
+
+SAMPLE_PHENOTYPES = [
+    "Chronic cough", "Recurrent wheezing", "Failure to thrive", "Recurrent respiratory infections",
+    "Foul smelling stools", "Poor weight gain", "Digital clubbing", "Nasal polyposis", "Nasal polyps",
+    "Hepatomegaly", "Hyponatremia", "Hypochloremia", "Elevated sweat chloride", "Bronchiectasis",
+    "Seizure", "Seizures", "Hypotonia", "Global developmental delay", "Developmental delay", "Cough",
+]
+
+
+def write_synthetic_obo(path, n_terms, seed=0):
+    rng = random.Random(seed)
+    syllables = "ab ac al an ar bi bro car chi cy de dys en gi hy lo ma ne os pa po ra si ta to ul".split()
+    names = SAMPLE_PHENOTYPES + [
+        " ".join("".join(rng.choice(syllables) for _ in range(3)) for _ in range(rng.randint(1, 4)))
+        for _ in range(n_terms - len(SAMPLE_PHENOTYPES))
+    ]
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("format-version: 1.2\n\n[Term]\nid: HP:0000001\nname: All\n")
+        for i, name in enumerate(names, start=2):
+            parent = f"HP:{rng.randint(1, i - 1):07d}"
+            f.write(f"\n[Term]\nid: HP:{i:07d}\nname: {name}\nsynonym: \"{name} finding\" EXACT []\nis_a: {parent}\n")
+
+
+async def remote_lookup(api_url, text):
+    client = HPOClient(api_url=api_url)
+    terms = list({word for word, _, _ in tokenize(text) if word not in STOPWORDS})
+    await client.search_many(terms)
+    await client.aclose()
+    return len(terms)
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        ontology = args.ontology
+        if ontology is None:
+            ontology = os.path.join(tmp, "synthetic.obo")
+            write_synthetic_obo(ontology, args.synthetic_terms)
+
+        start = time.perf_counter()
+        index = HPOIndex.from_ontology(ontology)
+        build = time.perf_counter() - start
+
+        artifact = os.path.join(tmp, "hpo_index.pkl")
+        index.save(artifact)
+        start = time.perf_counter()
+        index = HPOIndex.load(artifact)
+        load = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            annotations = index.annotate(SAMPLE_CASE_REPORT)
+        local = (time.perf_counter() - start) / args.repeat
+
+        with StubServer(clinical_tables_app(latency=args.latency)) as stub:
+            start = time.perf_counter()
+            n_terms = asyncio.run(remote_lookup(f"{stub.url}/api/hpo/v3/search", SAMPLE_CASE_REPORT))
+            remote = time.perf_counter() - start
+
+    print(f"ontology: {len(index.labels)} terms, {len(index.phrases)} phrases")
+    print(f"index build: {build:.3f} s, pickle load: {load:.3f} s ({os.path.basename(ontology)})")
+    print(f"local annotate: {local * 1000:.3f} ms, {len(annotations)} matches")
+    print(f"remote search:  {remote * 1000:.1f} ms, {n_terms} searches at {args.latency * 1000:.0f} ms stub latency")
+    for annotation in annotations:
+        print(f"  {annotation.start:>4}-{annotation.end:<4} {annotation.hpo_id} {annotation.label!r}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--ontology", help="path to hp.obo or hp.json")
+    parser.add_argument("--synthetic-terms", type=int, default=18000)
+    parser.add_argument("--latency", type=float, default=0.05, help="stub response latency in seconds")
+    parser.add_argument("--repeat", type=int, default=100)
+    main(parser.parse_args())
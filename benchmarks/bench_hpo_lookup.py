@@ -0,0 +1,80 @@
+"""Compare the old serial HPO lookup with the pooled concurrent client.
+
+The "warm" column repeats the pooled lookup against a populated cache.
+
+Run from the repository root:
+
+    python benchmarks/bench_hpo_lookup.py --latency 0.05
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache import TTLCache  # noqa: E402
+from hpo_client import HPOClient  # noqa: E402
+from stub_servers import StubServer, clinical_tables_app  # noqa: E402
+
+VOCABULARY = (
+    "fever seizures hypotonia cough wheezing vomiting diarrhea rash jaundice "
+    "lethargy irritability macrocephaly microcephaly ataxia tremor hepatomegaly "
+    "splenomegaly anemia thrombocytopenia hyponatremia hypoglycemia tachycardia "
+    "murmur edema proteinuria hematuria scoliosis contractures ptosis nystagmus"
+).split()
+
+
+def make_case_report(n_words, seed=0):
+    rng = random.Random(seed)
+    words = VOCABULARY + [f"finding{i}" for i in range(n_words)]
+    return " ".join(rng.choice(words) for _ in range(n_words))
+
+
+def serial_lookup(api_url, terms):
+    # The original implementation: one blocking requests.get per token
+    for term in terms:
+        requests.get(f"{api_url}?terms={term}").json()
+
+
+async def pooled_lookup(client, terms):
+    await client.search_many(terms)
+
+
+async def main(args):
+    with StubServer(clinical_tables_app(latency=args.latency)) as stub:
+        api_url = f"{stub.url}/api/hpo/v3/search"
+        client = HPOClient(api_url=api_url, max_concurrency=args.concurrency)
+        cached_client = HPOClient(api_url=api_url, max_concurrency=args.concurrency, cache=TTLCache())
+        print(f"{'words':>6} {'terms':>6} {'serial (s)':>11} {'pooled (s)':>11} {'speedup':>8} {'warm (s)':>9}")
+        for n_words in args.lengths:
+            terms = list(set(make_case_report(n_words).split()))
+
+            start = time.perf_counter()
+            serial_lookup(api_url, terms)
+            serial = time.perf_counter() - start
+
+            start = time.perf_counter()
+            await pooled_lookup(client, terms)
+            pooled = time.perf_counter() - start
+
+            await pooled_lookup(cached_client, terms)
+            start = time.perf_counter()
+            await pooled_lookup(cached_client, terms)
+            warm = time.perf_counter() - start
+
+            print(f"{n_words:>6} {len(terms):>6} {serial:>11.3f} {pooled:>11.3f} {serial / pooled:>7.1f}x {warm:>9.4f}")
+        await client.aclose()
+        await cached_client.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--latency", type=float, default=0.05, help="stub response latency in seconds")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[25, 50, 100, 200, 300])
+    asyncio.run(main(parser.parse_args()))
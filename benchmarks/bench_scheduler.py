@@ -0,0 +1,201 @@
+"""Exercise the GPT-4 request scheduler against a rate-limited OpenAI stub.
+
+Run from the repository root:
+
+    python benchmarks/bench_scheduler.py --sessions 10 --requests 3 --limit 5
+
+Scenarios:
+  burst     many sessions at once against a server that allows --limit
+            requests per second; the old blind retry is run for comparison,
+            and the scheduler is run again honouring x-ratelimit-* headers
+            from successful responses, as the pipeline does
+  invalid   a non-retryable 400, which the scheduler fails on immediately
+  fairness  one session queues many requests while another sends one
+  fallback  the burst again, with a fallback model to absorb 429s
+  headers   how 429 Retry-After and x-ratelimit-* headers are read
+
+Each scenario also checks the scheduler's behaviour; the script exits with
+status 1 if any check fails, so it can guard against regressions.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+import httpx
+import openai
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from openai import AsyncOpenAI  # noqa: E402
+
+from scheduler import RequestScheduler, retry_after  # noqa: E402
+from stub_servers import StubServer, openai_app  # noqa: E402
+
+
+def rate_limit_error(headers):
+    response = httpx.Response(429, headers=headers, request=httpx.Request("POST", "http://stub/v1/chat/completions"))
+    return openai.RateLimitError("Rate limit reached", response=response, body=None)
+
+
+def completion(client, model="gpt-4"):
+    return client.chat.completions.create(model=model, max_tokens=20,
+                                          messages=[{"role": "user", "content": "stub"}])
+
+
+async def blind_retry(client, model="gpt-4", max_retries=3, initial_delay=0.2):
+    # The previous call_gpt4_with_retry, with its 2 s initial delay scaled down
+    for attempt in range(max_retries):
+        try:
+            return await completion(client, model)
+        except Exception:
+            if attempt == max_retries - 1:
+                raise
+            await asyncio.sleep(initial_delay)
+            initial_delay *= 2
+
+
+async def scheduled(client, scheduler, session, model="gpt-4"):
+    response, _ = await scheduler.run(lambda chosen: completion(client, chosen), model, tokens=100, key=session)
+    return response
+
+
+async def scheduled_observing(client, scheduler, session, model="gpt-4"):
+    async def request(chosen):
+        raw = await client.chat.completions.with_raw_response.create(
+            model=chosen, max_tokens=20, messages=[{"role": "user", "content": "stub"}])
+        scheduler.observe(raw.headers, chosen)
+        return raw.parse()
+
+    response, _ = await scheduler.run(request, model, tokens=100, key=session)
+    return response
+
+
+async def run_sessions(make_call, sessions, requests):
+    # Each session sends its requests one after another, like a clinician clicking Submit
+    async def session(i):
+        ok = failed = 0
+        for _ in range(requests):
+            try:
+                await make_call(i)
+                ok += 1
+            except Exception:
+                failed += 1
+        return ok, failed
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(session(i) for i in range(sessions)))
+    return sum(r[0] for r in results), sum(r[1] for r in results), time.perf_counter() - start
+
+
+def report(name, stats, ok, failed, elapsed):
+    """Print a scenario's results and return the stub's request counts for it."""
+    print(f"{name:<22} ok={ok:<4} failed={failed:<4} 429s={stats.get(429, 0):<5} "
+          f"fallback={stats.get('fallback', 0):<4} {elapsed:6.2f}s")
+    counts = dict(stats)
+    stats.clear()
+    return counts
+
+
+FAILURES = []
+
+
+def check(condition, description):
+    print(f"  {'ok  ' if condition else 'FAIL'} {description}")
+    if not condition:
+        FAILURES.append(description)
+
+
+async def main(args):
+    app = openai_app(latency=args.latency, token_delay=0, n_tokens=20, requests_per_second=args.limit)
+    stats = app.state.stats
+    with StubServer(app) as stub:
+        client = AsyncOpenAI(base_url=f"{stub.url}/v1", api_key="sk-stub", max_retries=0)
+
+        print("burst")
+        result = await run_sessions(lambda i: blind_retry(client), args.sessions, args.requests)
+        report("  blind retry", stats, *result)
+        await asyncio.sleep(1)
+        scheduler = RequestScheduler(max_concurrency=args.concurrency, max_retries=5, backoff=0.2)
+        result = await run_sessions(lambda i: scheduled(client, scheduler, i), args.sessions, args.requests)
+        counts = report("  scheduler", stats, *result)
+        check(result[1] == 0, "every request in the burst succeeds through the scheduler")
+        await asyncio.sleep(1)
+        scheduler = RequestScheduler(max_concurrency=args.concurrency, max_retries=5, backoff=0.2)
+        result = await run_sessions(lambda i: scheduled_observing(client, scheduler, i), args.sessions, args.requests)
+        observed = report("  scheduler + headers", stats, *result)
+        check(result[1] == 0 and observed.get(429, 0) < counts.get(429, 0),
+              "honouring x-ratelimit-* headers avoids most 429s")
+
+        print("invalid")
+        await asyncio.sleep(1)
+        start = time.perf_counter()
+        try:
+            await blind_retry(client, "invalid-model")
+        except Exception:
+            pass
+        report("  blind retry", stats, 0, 1, time.perf_counter() - start)
+        start = time.perf_counter()
+        try:
+            await scheduled(client, RequestScheduler(), "s", "invalid-model")
+        except Exception:
+            pass
+        counts = report("  scheduler", stats, 0, 1, time.perf_counter() - start)
+        check(sum(counts.values()) == 1, "a 400 is sent exactly once, without retries")
+
+        print("fairness")
+        await asyncio.sleep(1)
+        scheduler = RequestScheduler(max_concurrency=2, requests_per_minute=args.limit * 60)
+        start = time.perf_counter()
+        heavy = asyncio.gather(*(scheduled(client, scheduler, "heavy") for _ in range(args.sessions * 2)))
+        await asyncio.sleep(0.01)
+        await scheduled(client, scheduler, "light")
+        light_done = time.perf_counter() - start
+        await heavy
+        heavy_done = time.perf_counter() - start
+        print(f"  light session done after {light_done:.2f}s; heavy session's "
+              f"{args.sessions * 2} requests after {heavy_done:.2f}s")
+        stats.clear()
+        check(light_done < heavy_done, "the light session finishes before the heavy session's queue drains")
+
+        print("fallback")
+        await asyncio.sleep(1)
+        scheduler = RequestScheduler(max_concurrency=args.concurrency, max_retries=5, backoff=0.2,
+                                     fallback_model="gpt-4o-mini")
+
+        async def call_with_fallback(i):
+            response = await scheduled(client, scheduler, i)
+            if response.model != "gpt-4":
+                stats["fallback"] = stats.get("fallback", 0) + 1
+            return response
+
+        result = await run_sessions(call_with_fallback, args.sessions, args.requests)
+        counts = report("  scheduler + fallback", stats, *result)
+        check(result[1] == 0, "every request succeeds with a fallback model")
+        check(counts.get("fallback", 0) > 0, "requests go to the fallback model while the primary is rate limited")
+
+    print("headers")
+    check(retry_after(rate_limit_error({"retry-after-ms": "250"})) == 0.25, "retry-after-ms is read in milliseconds")
+    check(retry_after(rate_limit_error({"retry-after": "2"})) == 2, "retry-after is read in seconds")
+    check(retry_after(rate_limit_error({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"})) == 0,
+          "a retry-after date in the past means retry now")
+    check(retry_after(rate_limit_error({"retry-after": "soon"})) is None,
+          "a malformed retry-after falls back to backoff")
+    check(retry_after(rate_limit_error({"x-ratelimit-remaining-tokens": "0", "x-ratelimit-reset-tokens": "6m0s"}))
+          == 360, "x-ratelimit-reset-* is used when there is no retry-after")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.ERROR)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=3, help="requests per session")
+    parser.add_argument("--limit", type=int, default=5, help="stub requests per second for the primary model")
+    parser.add_argument("--concurrency", type=int, default=4, help="scheduler in-flight cap")
+    parser.add_argument("--latency", type=float, default=0.1, help="stub response latency in seconds")
+    asyncio.run(main(parser.parse_args()))
+    if FAILURES:
+        print(f"{len(FAILURES)} check(s) failed")
+        sys.exit(1)
@@ -0,0 +1,253 @@
+"""Check the building blocks the pipeline relies on, without any network access.
+
+Run from the repository root:
+
+    python benchmarks/check_components.py
+
+Sections:
+  singleflight  coalescing, cancelling callers, and publishing to subscribers
+  cache         TTL expiry, LRU eviction, the SQLite store, and negative
+                caching of empty HPO searches
+  prompt        HPO match deduplication and ranking, and the token budget
+  annotate      offline HPO index matches and their spans in the case text
+
+The script exits with status 1 if any check fails, so it can guard against
+regressions.
+"""
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from starlette.applications import Starlette  # noqa: E402
+from starlette.responses import JSONResponse  # noqa: E402
+from starlette.routing import Route  # noqa: E402
+
+from cache import SingleFlight, TTLCache  # noqa: E402
+from hpo_client import HPOClient  # noqa: E402
+from hpo_index import HPOIndex  # noqa: E402
+from prompt_builder import HPOMatch, build_prompt, prompt_budget, rank_matches  # noqa: E402
+from stub_servers import StubServer  # noqa: E402
+
+FAILURES = []
+
+
+def check(condition, description):
+    print(f"  {'ok  ' if condition else 'FAIL'} {description}")
+    if not condition:
+        FAILURES.append(description)
+
+
+async def check_singleflight():
+    print("singleflight")
+    flight = SingleFlight()
+    calls = []
+    release = asyncio.Event()
+
+    async def work(key):
+        calls.append(key)
+        await release.wait()
+        await flight.publish(key, "partial")
+        return key.upper()
+
+    first = asyncio.ensure_future(flight.do("a", lambda: work("a")))
+    second = asyncio.ensure_future(flight.do("a", lambda: work("a")))
+    await asyncio.sleep(0)
+    release.set()
+    check(await asyncio.gather(first, second) == ["A", "A"] and calls == ["a"],
+          "concurrent calls for one key share a single call")
+    check(flight.coalesced == 1, "the second caller is counted as coalesced")
+
+    # Cancelling one of two callers leaves the call running for the other
+    release.clear()
+    calls.clear()
+    first = asyncio.ensure_future(flight.do("b", lambda: work("b")))
+    second = asyncio.ensure_future(flight.do("b", lambda: work("b")))
+    await asyncio.sleep(0)
+    first.cancel()
+    await asyncio.sleep(0)
+    release.set()
+    check(await second == "B" and first.cancelled(), "a cancelled caller doesn't cancel the call for the others")
+
+    # Cancelling the last caller cancels the call, and the next caller starts afresh
+    release.clear()
+    calls.clear()
+    started = asyncio.Event()
+
+    async def slow():
+        started.set()
+        await asyncio.sleep(60)
+
+    only = asyncio.ensure_future(flight.do("c", slow))
+    await started.wait()
+    task = flight._inflight["c"].task
+    only.cancel()
+    await asyncio.gather(only, return_exceptions=True)
+    await asyncio.sleep(0)
+    check(task.cancelled(), "the call is cancelled once its last caller is")
+    release.set()
+    check(await flight.do("c", lambda: work("c")) == "C" and calls == ["c"],
+          "a caller after the cancellation starts a new call")
+
+    # Subscribers get what is published while they wait; a failing one is dropped
+    release.clear()
+    received = {"a": [], "b": []}
+
+    def subscriber(name):
+        async def on_publish(text):
+            received[name].append(text)
+        return on_publish
+
+    async def broken(text):
+        raise RuntimeError("session closed")
+
+    async def publishing():
+        await release.wait()
+        for text in ("one", "two"):
+            await flight.publish("d", text)
+        return "done"
+
+    waiters = [asyncio.ensure_future(flight.do("d", publishing, subscriber=subscriber("a"))),
+               asyncio.ensure_future(flight.do("d", publishing, subscriber=broken)),
+               asyncio.ensure_future(flight.do("d", publishing, subscriber=subscriber("b")))]
+    await asyncio.sleep(0)
+    waiters[2].cancel()
+    await asyncio.sleep(0)
+    logging.disable(logging.ERROR)
+    release.set()
+    results = await asyncio.gather(*waiters, return_exceptions=True)
+    logging.disable(logging.NOTSET)
+    check(results[:2] == ["done", "done"], "a failing subscriber doesn't fail the call")
+    check(received["a"] == ["one", "two"], "a waiting caller's subscriber receives every publish")
+    check(received["b"] == [], "a cancelled caller's subscriber receives nothing more")
+    check(not flight._inflight, "finished calls are forgotten")
+    await flight.publish("d", "late")
+    check(received["a"] == ["one", "two"], "publishing with no call in flight is a no-op")
+
+
+async def check_cache():
+    print("cache")
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("short", 1, ttl=0.05)
+    check(cache.get("short") == 1, "an entry is returned before it expires")
+    time.sleep(0.1)
+    check(cache.get("short", "missing") == "missing", "an entry is gone once its ttl has passed")
+
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    check(cache.get("b") is None and cache.get("a") == 1 and cache.get("c") == 3,
+          "the least recently used entry is evicted at maxsize")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "cache.sqlite")
+        cache = TTLCache(maxsize=2, path=path)
+        cache.set("kept", {"value": [1, 2]})
+        cache.set("expiring", "x", ttl=0.05)
+        cache.close()
+        time.sleep(0.1)
+        cache = TTLCache(maxsize=2, path=path)
+        check(cache.get("kept") == {"value": [1, 2]}, "entries survive a restart through the SQLite store")
+        check(cache.get("expiring") is None, "expired entries aren't read back from the store")
+        for key in "xyz":
+            cache.set(key, key)
+        cache.close()
+        cache = TTLCache(maxsize=10, path=path)
+        check(cache.get("kept") is None and cache.get("z") == "z", "the store keeps at most maxsize entries")
+        cache.close()
+
+    requests = []
+
+    async def search(request):
+        term = request.query_params["terms"]
+        requests.append(term)
+        if term == "zzz":
+            return JSONResponse([0, [], None, []])
+        return JSONResponse([1, ["HP:0001250"], None, [["HP:0001250", "Seizure"]]])
+
+    app = Starlette(routes=[Route("/api/hpo/v3/search", search)])
+    with StubServer(app) as server:
+        client = HPOClient(api_url=f"{server.url}/api/hpo/v3/search", cache=TTLCache(), negative_ttl=0.2)
+        try:
+            for term in ("zzz", "ZZZ", "seizure", "Seizure"):
+                await client.search(term)
+            check(requests == ["zzz", "seizure"], "repeat searches, with or without matches, are served from the cache")
+            await asyncio.sleep(0.3)
+            await client.search("zzz")
+            await client.search("seizure")
+            check(requests == ["zzz", "seizure", "zzz"],
+                  "a search with no matches is repeated after negative_ttl, one with matches is not")
+        finally:
+            await client.aclose()
+
+
+def check_prompt():
+    print("prompt")
+    case_report = "Recurrent seizures and global developmental delay since infancy."
+    matches = [
+        HPOMatch("HP:0000707", "Abnormality of the nervous system", "seizures"),
+        HPOMatch("HP:0001250", "Seizure", "seizures"),
+        HPOMatch("HP:0001263", "Global developmental delay", "global developmental delay"),
+        HPOMatch("HP:0001263", "Global developmental delay", "delay"),
+        HPOMatch("HP:0001250", "Seizure", "recurrent seizures"),
+    ]
+    ranked = rank_matches(case_report, matches)
+    check([hpo_id for hpo_id, _ in ranked] == ["HP:0001263", "HP:0001250", "HP:0000707"],
+          "matches are deduplicated by HPO ID and ranked by relevance to the case")
+
+    check(prompt_budget("gpt-4", 500) == 8192 - 500 - 20, "the budget is the context window less the completion")
+    check(prompt_budget("gpt-4", 500, limit=1000) == 1000, "a configured budget caps it")
+
+    many = [HPOMatch(f"HP:{i:07d}", f"Phenotype number {i} of the nervous system", "nervous")
+            for i in range(400)]
+    prompt = build_prompt(case_report, many, budget=300)
+    check(prompt.tokens <= 300, "the prompt fits the budget")
+    check(0 < prompt.terms_kept < prompt.terms_total == 400, "terms that don't fit are dropped")
+    check(prompt.baseline_tokens > prompt.tokens, "the baseline records what unbudgeted slicing would send")
+
+    long_report = "The patient had seizures. " * 500
+    prompt = build_prompt(long_report, matches, budget=200)
+    check(prompt.tokens <= 200, "a case report too long for the budget is truncated to fit")
+    check(prompt.text.startswith("Given the following patient case report") and prompt.terms_kept == 0,
+          "the case report is kept ahead of the terms")
+
+
+def check_annotate():
+    print("annotate")
+    labels = {
+        "HP:0001250": "Seizure",
+        "HP:0001263": "Global developmental delay",
+        "HP:0012758": "Neurodevelopmental delay",
+        "HP:0000750": "Delayed speech and language development",
+    }
+    synonyms = {"HP:0001250": ["Seizures", "Epileptic seizure"], "HP:0012758": ["Developmental delay"]}
+    index = HPOIndex(labels, synonyms, {})
+    text = "Recurrent SEIZURES, then global\ndevelopmental  delay; developmental delay in a sibling."
+    annotations = index.annotate(text)
+    check([a.hpo_id for a in annotations] == ["HP:0001250", "HP:0001263", "HP:0012758"],
+          "the longest matching phrase wins, case-insensitively")
+    check(all(text[a.start:a.end] == a.text for a in annotations), "spans index into the original text")
+    check([a.text for a in annotations] == ["SEIZURES", "global\ndevelopmental  delay", "developmental delay"],
+          "a span covers the whole phrase, including the original whitespace")
+    check(annotations[0].label == "Seizure", "a synonym match reports the term's label")
+    check(index.annotate("and the of a") == [], "stopwords alone match nothing")
+
+
+async def main():
+    await check_singleflight()
+    await check_cache()
+    check_prompt()
+    check_annotate()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.run(main())
+    if FAILURES:
+        print(f"{len(FAILURES)} check(s) failed")
+        sys.exit(1)
@@ -0,0 +1,301 @@
+"""Load-test the Shiny app end to end against stubbed HPO and OpenAI backends.
+
+Starts the stub servers from stub_servers.py, serves GPT4HPO.app from a
+subprocess on a local port and connects --sessions simulated browsers over the Shiny websocket. Each
+session submits --submissions case reports of varying length through the real
+process_case_report path and waits for the response to reach the page.
+
+Reports p50/p95/p99 latency to the first streamed update and to the final
+response, throughput, and how long the app's event loop was blocked. Results
+are written as JSON so runs can be compared:
+
+    python benchmarks/load_test.py --sessions 20 --output before.json
+    python benchmarks/load_test.py --sessions 20 --output after.json --compare before.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import httpx  # noqa: E402
+import websockets  # noqa: E402
+
+from bench_hpo_lookup import make_case_report  # noqa: E402
+from starlette.responses import JSONResponse  # noqa: E402
+
+from stub_servers import StubServer, clinical_tables_app, openai_app  # noqa: E402
+
+# Tell the server the response output is on screen, as a browser would, so it gets rendered
+VISIBLE_OUTPUTS = {".clientdata_output_output_area_hidden": False}
+
+
+def percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "mean": None, "max": None}
+    ordered = sorted(values)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99),
+            "mean": statistics.fmean(ordered), "max": ordered[-1]}
+
+
+class LoopLagMonitor:
+    """Sample how late a periodic timer fires on an event loop.
+
+    Lag beyond threshold means something ran on the loop without yielding;
+    the sum of those lags approximates the time the loop was blocked.
+    """
+
+    def __init__(self, interval=0.01, threshold=0.005):
+        self.interval = interval
+        self.threshold = threshold
+        self.lags = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - start - self.interval))
+
+    def start(self, loop):
+        async def create():
+            self._task = asyncio.create_task(self._run())
+        asyncio.run_coroutine_threadsafe(create(), loop).result()
+
+    def stop(self, loop):
+        loop.call_soon_threadsafe(self._task.cancel)
+
+    def summary(self):
+        blocked = [lag for lag in self.lags if lag > self.threshold]
+        return {"samples": len(self.lags), "blocked_seconds": sum(blocked), "blocked_samples": len(blocked),
+                "max_lag": max(self.lags, default=0.0), "p99_lag": percentiles(self.lags)["p99"]}
+
+
+def failure(text):
+    """The error a run ended with, from the log the app shows in place of a response."""
+    last_line = text.rstrip().splitlines()[-1] if text.strip() else ""
+    if last_line.startswith("An error occurred") or last_line == "Request to GPT-4 timed out.":
+        return last_line
+    return None
+
+
+async def run_session(url, index, args, results):
+    """One simulated browser: connect, then submit case reports one after another."""
+    async with websockets.connect(url, max_size=None) as ws:
+        await ws.send(json.dumps({"method": "init", "data": {
+            "case_report": "", "submit:shiny.action": 0, **VISIBLE_OUTPUTS}}))
+        # Wait for the initial render before submitting
+        while "values" not in json.loads(await ws.recv()):
+            pass
+
+        for k in range(args.submissions):
+            n_words = args.lengths[(index + k) % len(args.lengths)]
+            seed = k if args.repeat else index * args.submissions + k
+            case_report = make_case_report(n_words, seed=seed)
+            if not args.repeat:
+                # Keep every submission distinct so none is a response-cache hit
+                case_report = f"Patient {index}-{k}: {case_report}"
+
+            await ws.send(json.dumps({"method": "update", "data": {
+                "case_report": case_report, "submit:shiny.action": k + 1}}))
+            start = time.perf_counter()
+            first_update = None
+            text = None
+            try:
+                # Each submit clears the output, so the run is over when its
+                # result (or error log) is rendered
+                while not text:
+                    message = json.loads(await asyncio.wait_for(ws.recv(), args.timeout))
+                    # The submit first sends an empty update to clear the page
+                    if message.get("custom", {}).get("stream-output") and first_update is None:
+                        first_update = time.perf_counter() - start
+                    text = message.get("values", {}).get("output_area")
+                error = failure(text)
+            except asyncio.TimeoutError:
+                error = f"no response after {args.timeout}s"
+            elapsed = time.perf_counter() - start
+            results.append({"session": index, "words": n_words, "ok": error is None, "error": error,
+                            "latency": elapsed,
+                            "first_update": first_update if first_update is not None else elapsed})
+            if not text:
+                # A late response would be mistaken for the next one's, so stop here
+                return
+            if args.think_time:
+                await asyncio.sleep(args.think_time)
+
+
+def stage_means(exposition):
+    """Mean seconds per pipeline stage from the app's /metrics output."""
+    sums, counts = {}, {}
+    for line in exposition.splitlines():
+        for suffix, target in (("_sum", sums), ("_count", counts)):
+            prefix = f"diagnosis_stage_seconds{suffix}{{stage=\""
+            if line.startswith(prefix):
+                stage, value = line[len(prefix):].split("\"} ")
+                target[stage] = float(value)
+    return {stage: sums[stage] / counts[stage] for stage in sums if counts.get(stage)}
+
+
+def print_report(result, baseline=None):
+    def row(name, stats, key):
+        old = baseline and baseline.get(key, {})
+        line = f"  {name:<14}" + "".join(
+            f" {q}={stats[q] * 1000:8.1f}ms" if stats[q] is not None else f" {q}=     n/a"
+            for q in ("p50", "p95", "p99"))
+        if old and old.get("p50") is not None and stats["p50"] is not None:
+            line += f"   (baseline p50={old['p50'] * 1000:.1f}ms p95={old['p95'] * 1000:.1f}ms)"
+        print(line)
+
+    print(f"{result['completed']} submissions ({result['failed']} failed) from {result['config']['sessions']} "
+          f"sessions in {result['wall_seconds']:.2f}s: {result['throughput']:.2f}/s"
+          + (f" (baseline {baseline['throughput']:.2f}/s)" if baseline else ""))
+    row("first update", result["first_update"], "first_update")
+    row("response", result["latency"], "latency")
+    for words, stats in sorted(result["latency_by_words"].items(), key=lambda item: int(item[0])):
+        row(f"  {words} words", stats, None)
+    loop = result["event_loop"]
+    print(f"  event loop blocked {loop['blocked_seconds'] * 1000:.1f}ms over {loop['blocked_samples']} samples, "
+          f"max lag {loop['max_lag'] * 1000:.1f}ms"
+          + (f" (baseline {baseline['event_loop']['blocked_seconds'] * 1000:.1f}ms)" if baseline else ""))
+    for stage, mean in sorted(result["stage_means"].items()):
+        print(f"  {stage:<22} mean {mean * 1000:8.1f}ms")
+
+
+async def drive(app_url, args):
+    url = app_url.replace("http://", "ws://") + "/websocket/"
+    results = []
+    start = time.perf_counter()
+    await asyncio.gather(*(run_session(url, i, args, results) for i in range(args.sessions)))
+    wall = time.perf_counter() - start
+    async with httpx.AsyncClient() as client:
+        exposition = (await client.get(f"{app_url}/metrics")).text
+    return results, wall, exposition
+
+
+def serve_app():
+    """Run in the app subprocess: serve GPT4HPO.app, print its URL, and stop when stdin closes.
+
+    The app's event-loop lag is served as JSON at /loop-lag.
+    """
+    import GPT4HPO
+
+    monitor = LoopLagMonitor()
+
+    async def app(scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == "/loop-lag":
+            await JSONResponse(monitor.summary())(scope, receive, send)
+        else:
+            await GPT4HPO.app(scope, receive, send)
+
+    with StubServer(app) as server:
+        loop = server.server.servers[0].get_loop()
+        monitor.start(loop)
+        print(server.url, flush=True)
+        sys.stdin.read()
+        monitor.stop(loop)
+
+
+@contextmanager
+def app_process(env):
+    """Start the app in a subprocess and yield its URL.
+
+    The app reads OPENAI_API_KEY only from a .env file, so the subprocess runs
+    in a temporary directory holding one with a stub key. It is started with
+    -c so load_dotenv() looks for .env in the working directory, not the repo.
+    """
+    with tempfile.TemporaryDirectory() as workdir:
+        with open(os.path.join(workdir, ".env"), "w") as f:
+            f.write("OPENAI_API_KEY=sk-stub\n")
+        code = f"import sys; sys.path[:0] = {[REPO_DIR, BENCHMARKS_DIR]!r}; import load_test; load_test.serve_app()"
+        process = subprocess.Popen([sys.executable, "-c", code], cwd=workdir, env=env,
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        try:
+            url = process.stdout.readline().strip()
+            if not url:
+                raise RuntimeError("the app failed to start")
+            yield url
+        finally:
+            process.stdin.close()
+            process.wait()
+
+
+def main(args):
+    hpo = StubServer(clinical_tables_app(latency=args.hpo_latency, error_rate=args.hpo_error_rate))
+    openai_stub = StubServer(openai_app(latency=args.openai_latency, token_delay=args.token_delay,
+                                        n_tokens=args.tokens, error_rate=args.openai_error_rate))
+    with hpo, openai_stub:
+        # The rest of the app's configuration comes from the environment as usual
+        env = dict(os.environ, **{
+            "OPENAI_BASE_URL": f"{openai_stub.url}/v1",
+            "HPO_API_URL": f"{hpo.url}/api/hpo/v3/search",
+            "LOG_LEVEL": os.environ.get("LOG_LEVEL", "ERROR"),
+        })
+        with app_process(env) as app_url:
+            results, wall, exposition = asyncio.run(drive(app_url, args))
+            event_loop = httpx.get(f"{app_url}/loop-lag").json()
+
+    ok = [r for r in results if r["ok"]]
+    by_words = {}
+    for r in ok:
+        by_words.setdefault(str(r["words"]), []).append(r["latency"])
+    return {
+        "config": vars(args) | {"python": platform.python_version(), "timestamp": time.time()},
+        "completed": len(results),
+        "failed": len(results) - len(ok),
+        "wall_seconds": wall,
+        "throughput": len(ok) / wall,
+        "latency": percentiles([r["latency"] for r in ok]),
+        "first_update": percentiles([r["first_update"] for r in ok]),
+        "latency_by_words": {words: percentiles(values) for words, values in by_words.items()},
+        "event_loop": event_loop,
+        "stage_means": stage_means(exposition),
+        "samples": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=10, help="concurrent simulated browsers")
+    parser.add_argument("--submissions", type=int, default=3, help="case reports submitted per session")
+    parser.add_argument("--lengths", type=lambda s: [int(n) for n in s.split(",")], default=[20, 80, 300],
+                        help="comma-separated case report lengths in words, cycled across submissions")
+    parser.add_argument("--repeat", action="store_true",
+                        help="give every session the same case reports so the response cache can serve them")
+    parser.add_argument("--think-time", type=float, default=0.0, help="pause between a session's submissions")
+    parser.add_argument("--timeout", type=float, default=120.0, help="give up on a submission after this long")
+    parser.add_argument("--hpo-latency", type=float, default=0.05)
+    parser.add_argument("--hpo-error-rate", type=float, default=0.0)
+    parser.add_argument("--openai-latency", type=float, default=0.5, help="stub delay before the first token")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="stub delay between streamed tokens")
+    parser.add_argument("--tokens", type=int, default=200, help="tokens in each stub completion")
+    parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="a previous --output file to compare against")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    result = main(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
@@ -0,0 +1,144 @@
+"""Local stand-ins for the external services the app talks to.
+
+Each stub runs in its own thread with its own event loop, so the code under
+test sees real sockets and network latency without touching the internet.
+"""
+import asyncio
+import json
+import random
+import threading
+import time
+from collections import deque
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+
+def clinical_tables_app(latency=0.05, error_rate=0.0):
+    """Mimic /api/hpo/v3/search: [total, codes, extra, [[code, name], ...]]."""
+
+    async def search(request):
+        await asyncio.sleep(latency)
+        if random.random() < error_rate:
+            return JSONResponse({"error": "stub failure"}, status_code=503)
+        term = request.query_params.get("terms", "")
+        codes = [f"HP:{abs(hash((term, i))) % 10_000_000:07d}" for i in range(3)]
+        display = [[code, f"{term.capitalize()} variant {i}"] for i, code in enumerate(codes)]
+        return JSONResponse([len(codes), codes, None, display])
+
+    return Starlette(routes=[Route("/api/hpo/v3/search", search)])
+
+
+class StubServer:
+    """Run an ASGI app on 127.0.0.1 in a background thread."""
+
+    def __init__(self, app, port=0):
+        config = uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning")
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    @property
+    def url(self):
+        sock = self.server.servers[0].sockets[0]
+        host, port = sock.getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join()
+
+
+def openai_app(latency=0.2, token_delay=0.01, n_tokens=200, error_rate=0.0, requests_per_second=None):
+    """Mimic POST /v1/chat/completions, streamed (SSE) or not.
+
+    latency is the delay before the first token; token_delay is the gap
+    between streamed chunks. With requests_per_second set, requests for the
+    primary model over that rate get a 429 with Retry-After and
+    x-ratelimit-* headers, like the real API, and successful ones report
+    what is left of the current second's allowance. The model "invalid-model"
+    always gets a 400. Request counts by status are kept in app.state.stats.
+    """
+    window = deque()
+    stats = {}
+
+    def count(status):
+        stats[status] = stats.get(status, 0) + 1
+
+    def rate_limited(model):
+        if requests_per_second is None or model != "gpt-4":
+            return None
+        now = time.monotonic()
+        while window and window[0] <= now - 1:
+            window.popleft()
+        if len(window) >= requests_per_second:
+            reset = window[0] + 1 - now
+            return JSONResponse(
+                {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                status_code=429,
+                headers={"retry-after-ms": str(int(reset * 1000)), "x-ratelimit-remaining-requests": "0",
+                         "x-ratelimit-reset-requests": f"{int(reset * 1000)}ms"},
+            )
+        window.append(now)
+        return None
+
+    def limit_headers(model):
+        if requests_per_second is None or model != "gpt-4":
+            return {}
+        reset = window[0] + 1 - time.monotonic() if window else 0
+        return {"x-ratelimit-limit-requests": str(requests_per_second * 60),
+                "x-ratelimit-remaining-requests": str(max(requests_per_second - len(window), 0)),
+                "x-ratelimit-reset-requests": f"{max(int(reset * 1000), 1)}ms"}
+
+    async def chat_completions(request):
+        body = await request.json()
+        model = body.get("model", "gpt-4")
+        if model == "invalid-model":
+            count(400)
+            return JSONResponse({"error": {"message": "The model does not exist", "type": "invalid_request_error"}},
+                                status_code=400)
+        limited = rate_limited(model)
+        if limited is not None:
+            count(429)
+            return limited
+        if random.random() < error_rate:
+            count(503)
+            return JSONResponse({"error": {"message": "stub overloaded", "type": "server_error"}},
+                                status_code=503)
+        words = [f"word{i} " for i in range(min(n_tokens, body.get("max_tokens") or n_tokens))]
+        created = int(time.time())
+        count(200)
+        headers = limit_headers(model)
+
+        if not body.get("stream"):
+            await asyncio.sleep(latency + token_delay * len(words))
+            return JSONResponse({
+                "id": "chatcmpl-stub", "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": "".join(words)}}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(words), "total_tokens": len(words)},
+            }, headers=headers)
+
+        async def events():
+            await asyncio.sleep(latency)
+            for i, word in enumerate(words):
+                if i:
+                    await asyncio.sleep(token_delay)
+                chunk = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": created,
+                         "model": model, "choices": [{"index": 0, "delta": {"content": word},
+                                                      "finish_reason": None}]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
+
+    app = Starlette(routes=[Route("/v1/chat/completions", chat_completions, methods=["POST"])])
+    app.state.stats = stats
+    return app
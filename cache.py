@@ -0,0 +1,213 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+MISSING = object()
+
+
+class TTLCache:
+    """In-memory LRU cache with per-entry expiry and an optional SQLite backing store.
+
+    Values must be JSON-serialisable when a path is given. The disk store is
+    shared between restarts and between workers pointed at the same file, and
+    holds at most maxsize unexpired entries. Writes to it are batched and,
+    inside an event loop, run in a worker thread so they don't block it.
+    Reads use their own connection, which WAL mode never makes wait for a
+    writer, so a slow write (e.g. another worker holding the file) can't
+    stall lookups.
+    """
+
+    def __init__(self, maxsize=4096, ttl=7 * 24 * 3600, path=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._db = None
+        self._reader = None
+        # key -> (value, expires) waiting to be written to disk
+        self._pending = {}
+        self._flushing = None
+        self._lock = threading.Lock()
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)"
+            )
+            self._db.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+            self._reader = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+
+    def get(self, key, default=None):
+        now = time.time()
+        entry = self._entries.get(key) or self._pending.get(key)
+        if entry is not None:
+            value, expires = entry
+            if expires > now:
+                self._remember(key, value, expires)
+                self.hits += 1
+                return value
+            self._entries.pop(key, None)
+
+        if self._reader is not None:
+            row = self._reader.execute("SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[1] > now:
+                value = json.loads(row[0])
+                self._remember(key, value, row[1])
+                self.hits += 1
+                return value
+
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        self._remember(key, value, expires)
+        if self._db is not None:
+            self._pending[key] = (value, expires)
+            self._schedule_flush()
+
+    def _remember(self, key, value, expires):
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _schedule_flush(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        if self._flushing is None:
+            self._flushing = loop.create_task(self._flush_in_thread())
+
+    async def _flush_in_thread(self):
+        try:
+            # Writes made while a batch is being written go out in the next one
+            while self._pending:
+                batch, self._pending = self._pending, {}
+                try:
+                    await asyncio.to_thread(self._write, batch)
+                except Exception:
+                    # Keep the entries (newer writes win) so the next set() tries again
+                    logger.exception("Failed to write %d cache entries to %s", len(batch), self.path)
+                    self._pending = {**batch, **self._pending}
+                    break
+        finally:
+            self._flushing = None
+
+    def flush(self):
+        """Write pending entries to disk now."""
+        batch, self._pending = self._pending, {}
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch):
+        with self._lock:
+            if self._db is None:
+                return
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+                    [(key, json.dumps(value), expires) for key, (value, expires) in batch.items()],
+                )
+                # Keep the table bounded: drop expired rows, then the ones closest to expiry
+                self._db.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+                self._db.execute(
+                    "DELETE FROM cache WHERE key NOT IN (SELECT key FROM cache ORDER BY expires DESC LIMIT ?)",
+                    (self.maxsize,),
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def clear(self):
+        self._entries.clear()
+        self._pending.clear()
+        if self._db is not None:
+            with self._lock:
+                self._db.execute("DELETE FROM cache")
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+    def close(self):
+        if self._db is not None:
+            self.flush()
+            with self._lock:
+                self._db.close()
+                self._db = None
+            self._reader.close()
+            self._reader = None
+
+
+class _Call:
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+        self.subscribers = []
+
+
+class SingleFlight:
+    """Coalesce concurrent calls for the same key into one in-flight task.
+
+    Each caller may pass a subscriber, an async callable that receives
+    whatever the task publishes under its key while that caller is waiting.
+    The task is cancelled once every caller waiting on it has been cancelled.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._inflight = {}
+
+    async def do(self, key, func, subscriber=None):
+        call = self._inflight.get(key)
+        if call is None:
+            call = self._inflight[key] = _Call(asyncio.ensure_future(func()))
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+        else:
+            self.coalesced += 1
+        call.waiters += 1
+        if subscriber is not None:
+            call.subscribers.append(subscriber)
+        try:
+            # Shield so one cancelled caller doesn't cancel the call for everyone else
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            if call.waiters == 1 and not call.task.done():
+                # The last caller gave up, so nobody needs the result; a new
+                # caller for the same key starts a fresh call
+                self._forget(key, call)
+                call.task.cancel()
+            raise
+        finally:
+            call.waiters -= 1
+            # publish() may already have dropped it
+            if subscriber in call.subscribers:
+                call.subscribers.remove(subscriber)
+
+    async def publish(self, key, *args):
+        """Pass args to every current subscriber of the call in flight for key."""
+        call = self._inflight.get(key)
+        for subscriber in list(call.subscribers) if call is not None else ():
+            try:
+                await subscriber(*args)
+            except Exception:
+                # One broken subscriber (e.g. a closed session) shouldn't fail the call for the rest
+                logger.exception("Dropping a subscriber that failed")
+                if subscriber in call.subscribers:
+                    call.subscribers.remove(subscriber)
+
+    def _forget(self, key, call):
+        if self._inflight.get(key) is call:
+            del self._inflight[key]
@@ -0,0 +1,115 @@
+import asyncio
+import random
+
+import httpx
+
+import metrics
+from cache import MISSING, SingleFlight
+
+HPO_API_URL = "https://clinicaltables.nlm.nih.gov/api/hpo/v3/search"
+
+
+class HPOClient:
+    """Async client for the Clinical Tables HPO search API.
+
+    A single pooled httpx.AsyncClient is shared by every lookup, and a
+    semaphore bounds how many searches are in flight at once. When a cache
+    is given, results (including searches with no matches, which are kept
+    for negative_ttl seconds) are served from it, and concurrent lookups
+    of the same term share one request.
+    """
+
+    def __init__(self, api_url=HPO_API_URL, max_concurrency=8, timeout=5.0,
+                 max_retries=3, backoff=0.25, cache=None, negative_ttl=3600):
+        self.api_url = api_url
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.cache = cache
+        self.negative_ttl = negative_ttl
+        self._inflight = SingleFlight()
+        self._client = None
+        self._semaphore = None
+
+    def _get_client(self):
+        # Create the connection pool lazily so it binds to the running event loop
+        if self._client is None or self._client.is_closed:
+            limits = httpx.Limits(max_connections=self.max_concurrency,
+                                  max_keepalive_connections=self.max_concurrency)
+            self._client = httpx.AsyncClient(timeout=self.timeout, limits=limits)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._client
+
+    async def search(self, term):
+        if self.cache is None:
+            return await self._fetch(term)
+
+        key = term.lower()
+        cached = self.cache.get(key, MISSING)
+        if cached is not MISSING:
+            return cached
+        return await self._inflight.do(key, lambda: self._fetch_and_store(key, term))
+
+    async def _fetch_and_store(self, key, term):
+        result = await self._fetch(term)
+        no_matches = not result or not result[0]
+        self.cache.set(key, result, ttl=self.negative_ttl if no_matches else None)
+        return result
+
+    async def _fetch(self, term):
+        client = self._get_client()
+        with metrics.span("hpo_lookup"):
+            return await self._fetch_with_retry(client, term)
+
+    async def _fetch_with_retry(self, client, term):
+        delay = self.backoff
+        for attempt in range(self.max_retries):
+            last_attempt = attempt == self.max_retries - 1
+            try:
+                # Hold a slot only for the request itself, not the backoff below
+                async with self._semaphore:
+                    response = await client.get(self.api_url, params={"terms": term})
+                metrics.hpo_api_requests_total.inc(status=response.status_code)
+                response.raise_for_status()
+                return response.json()
+            except httpx.HTTPStatusError as e:
+                # Only retry server-side failures; a 4xx will not get better
+                if e.response.status_code < 500 or last_attempt:
+                    raise
+            except httpx.TransportError:
+                metrics.hpo_api_requests_total.inc(status="error")
+                if last_attempt:
+                    raise
+            # Exponential backoff with jitter so concurrent lookups don't retry in lockstep
+            await asyncio.sleep(delay * (1 + random.random()))
+            delay *= 2
+
+    async def search_many(self, terms):
+        """Look up every term concurrently, returning {term: response}.
+
+        A term whose lookup fails maps to None instead of failing the batch.
+        """
+        results = await asyncio.gather(*(self.search(term) for term in terms),
+                                       return_exceptions=True)
+        return {term: (None if isinstance(result, Exception) else result)
+                for term, result in zip(terms, results)}
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+def parse_hpo_matches(hpo_response):
+    """Return (hpo_id, label) pairs from a search response.
+
+    The search API returns [total, codes, extra, display_strings], where each
+    display string is [code, name].
+    """
+    matches = []
+    if hpo_response and len(hpo_response) > 3 and isinstance(hpo_response[3], list):
+        for item in hpo_response[3]:
+            if isinstance(item, list) and len(item) >= 2:
+                matches.append((item[0], item[1]))
+    return matches
@@ -0,0 +1,175 @@
+"""Offline phenotype matcher built from the HPO ontology (hp.obo or hp.json).
+
+Build the index once and point HPO_INDEX_PATH at the result:
+
+    python hpo_index.py hp.obo hpo_index.pkl
+"""
+import json
+import pickle
+import re
+import sys
+from collections import deque, namedtuple
+
+HPO_ROOT = "HP:0000001"
+
+WORD_RE = re.compile(r"[a-z0-9]+(?:'[a-z]+)?", re.IGNORECASE)
+
+STOPWORDS = frozenset("""
+a an and are as at be been but by for from had has have he her his in is it its
+of on or she that the their there they this to was were which with who
+""".split())
+
+Annotation = namedtuple("Annotation", "hpo_id label start end text")
+
+_SYNONYM_RE = re.compile(r'^"((?:[^"\\]|\\.)*)"')
+
+
+def tokenize(text):
+    """Yield (normalized_word, start, end) for each word in text."""
+    for match in WORD_RE.finditer(text):
+        yield match.group().lower(), match.start(), match.end()
+
+
+def normalize(text):
+    return " ".join(word for word, _, _ in tokenize(text))
+
+
+def load_obo(path):
+    """Return ({id: label}, {id: [synonyms]}, {id: [parent ids]}) for live HPO terms."""
+    labels, synonyms, parents = {}, {}, {}
+    term = None
+
+    def flush():
+        if term and term.get("id", "").startswith("HP:") and not term.get("obsolete"):
+            labels[term["id"]] = term.get("name", term["id"])
+            synonyms[term["id"]] = term["synonyms"]
+            parents[term["id"]] = term["is_a"]
+
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("["):
+                flush()
+                term = {"synonyms": [], "is_a": []} if line == "[Term]" else None
+            elif term is not None and ": " in line:
+                tag, value = line.split(": ", 1)
+                if tag == "id":
+                    term["id"] = value
+                elif tag == "name":
+                    term["name"] = value
+                elif tag == "synonym":
+                    match = _SYNONYM_RE.match(value)
+                    if match:
+                        term["synonyms"].append(match.group(1))
+                elif tag == "is_a":
+                    term["is_a"].append(value.split(" ! ")[0].strip())
+                elif tag == "is_obsolete" and value == "true":
+                    term["obsolete"] = True
+        flush()
+    return labels, synonyms, parents
+
+
+def load_json(path):
+    """Same as load_obo, for the OBO Graphs JSON release (hp.json)."""
+
+    def curie(iri):
+        return iri.rsplit("/", 1)[-1].replace("_", ":")
+
+    with open(path, encoding="utf-8") as f:
+        graph = json.load(f)["graphs"][0]
+
+    labels, synonyms, parents = {}, {}, {}
+    for node in graph.get("nodes", []):
+        hpo_id = curie(node["id"])
+        meta = node.get("meta", {})
+        if not hpo_id.startswith("HP:") or meta.get("deprecated") or "lbl" not in node:
+            continue
+        labels[hpo_id] = node["lbl"]
+        synonyms[hpo_id] = [s["val"] for s in meta.get("synonyms", [])]
+        parents[hpo_id] = []
+    for edge in graph.get("edges", []):
+        if edge.get("pred") == "is_a":
+            child, parent = curie(edge["sub"]), curie(edge["obj"])
+            if child in parents:
+                parents[child].append(parent)
+    return labels, synonyms, parents
+
+
+class HPOIndex:
+    """Precomputed phrase -> HPO term table with longest-match annotation."""
+
+    def __init__(self, labels, synonyms, parents):
+        self.labels = labels
+        self.depths = self._compute_depths(parents)
+        self.phrases = {}
+        # Longest phrase (in words) starting with each word, to bound the search
+        self.max_words = {}
+        for hpo_id, label in labels.items():
+            for text in [label] + synonyms.get(hpo_id, []):
+                phrase = normalize(text)
+                if not phrase or phrase in STOPWORDS:
+                    continue
+                ids = self.phrases.setdefault(phrase, [])
+                if hpo_id not in ids:
+                    ids.append(hpo_id)
+                words = phrase.split(" ")
+                self.max_words[words[0]] = max(self.max_words.get(words[0], 0), len(words))
+
+    @staticmethod
+    def _compute_depths(parents):
+        children = {}
+        for child, ids in parents.items():
+            for parent in ids:
+                children.setdefault(parent, []).append(child)
+        depths = {HPO_ROOT: 0}
+        queue = deque([HPO_ROOT])
+        while queue:
+            node = queue.popleft()
+            for child in children.get(node, []):
+                if child not in depths:
+                    depths[child] = depths[node] + 1
+                    queue.append(child)
+        return depths
+
+    @classmethod
+    def from_ontology(cls, path):
+        loader = load_json if path.endswith(".json") else load_obo
+        return cls(*loader(path))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def annotate(self, text):
+        """Return an Annotation for every longest phrase match in text, in order."""
+        tokens = list(tokenize(text))
+        annotations = []
+        i = 0
+        while i < len(tokens):
+            longest = min(self.max_words.get(tokens[i][0], 0), len(tokens) - i)
+            for n in range(longest, 0, -1):
+                ids = self.phrases.get(" ".join(word for word, _, _ in tokens[i:i + n]))
+                if ids:
+                    start, end = tokens[i][1], tokens[i + n - 1][2]
+                    for hpo_id in ids:
+                        annotations.append(Annotation(hpo_id, self.labels[hpo_id], start, end, text[start:end]))
+                    i += n
+                    break
+            else:
+                i += 1
+        return annotations
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("usage: python hpo_index.py <hp.obo|hp.json> <output.pkl>")
+    # Pickle the class under its importable name rather than __main__
+    from hpo_index import HPOIndex
+    index = HPOIndex.from_ontology(sys.argv[1])
+    index.save(sys.argv[2])
+    print(f"Indexed {len(index.labels)} terms and {len(index.phrases)} phrases into {sys.argv[2]}")
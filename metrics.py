@@ -0,0 +1,157 @@
+"""In-process counters and latency histograms, exported in Prometheus text format."""
+import bisect
+import time
+from contextlib import contextmanager
+
+from starlette.responses import PlainTextResponse
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # An unlabelled counter is exported as 0 before its first increment
+        self._values = {} if self.labelnames else {(): 0}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(str(labels[name]) for name in self.labelnames), 0)
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+
+class CounterFunc:
+    """A counter whose value is read from func() at collection time."""
+
+    def __init__(self, name, documentation, func):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        yield f"{self.name} {self.func()}"
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts (+Inf last), sum, count]
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for key, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [("le", bound)])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {count}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        # Re-registering a name (e.g. on module reload) replaces the old metric
+        self._metrics[metric.name] = metric
+        return metric
+
+    def exposition(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+stage_seconds = REGISTRY.register(Histogram(
+    "diagnosis_stage_seconds", "Time spent in each pipeline stage.", ["stage"]))
+requests_total = REGISTRY.register(Counter(
+    "diagnosis_requests_total", "Case reports processed, by outcome.", ["outcome"]))
+hpo_lookups_per_request = REGISTRY.register(Histogram(
+    "hpo_lookups_per_request", "HPO searches issued per case report.", buckets=COUNT_BUCKETS))
+hpo_api_requests_total = REGISTRY.register(Counter(
+    "hpo_api_requests_total", "Requests sent to the HPO search API, by status.", ["status"]))
+prompt_tokens = REGISTRY.register(Histogram(
+    "prompt_tokens", "Tokens in the GPT-4 user prompt.", buckets=TOKEN_BUCKETS))
+prompt_tokens_saved_total = REGISTRY.register(Counter(
+    "prompt_tokens_saved_total", "Prompt tokens saved compared with the old fixed truncation."))
+gpt4_retries_total = REGISTRY.register(Counter(
+    "gpt4_retries_total", "GPT-4 request attempts that were retried, by error type.", ["error"]))
+gpt4_rate_limited_total = REGISTRY.register(Counter(
+    "gpt4_rate_limited_total", "429 responses from the OpenAI API."))
+gpt4_fallback_total = REGISTRY.register(Counter(
+    "gpt4_fallback_total", "GPT-4 request attempts sent to the fallback model."))
+gpt4_timeouts_total = REGISTRY.register(Counter(
+    "gpt4_timeouts_total", "GPT-4 request attempts that timed out."))
+gpt4_time_to_first_token_seconds = REGISTRY.register(Histogram(
+    "gpt4_time_to_first_token_seconds", "Time from sending a streamed GPT-4 request to its first chunk."))
+
+
+def register_cache(prefix, cache, description):
+    """Export a TTLCache's hit and miss counters as <prefix>_hits_total / <prefix>_misses_total."""
+    REGISTRY.register(CounterFunc(f"{prefix}_hits_total", f"{description} hits.", lambda: cache.hits))
+    REGISTRY.register(CounterFunc(f"{prefix}_misses_total", f"{description} misses.", lambda: cache.misses))
+
+
+class Span:
+    elapsed = None
+
+
+@contextmanager
+def span(stage):
+    """Record the wall-clock time of the enclosed block under diagnosis_stage_seconds{stage=...}.
+
+    Yields a Span whose elapsed attribute is set when the block exits.
+    """
+    timer = Span()
+    start = time.perf_counter()
+    try:
+        yield timer
+    finally:
+        timer.elapsed = time.perf_counter() - start
+        stage_seconds.observe(timer.elapsed, stage=stage)
+
+
+async def metrics_endpoint(scope, receive, send):
+    """ASGI app serving REGISTRY in the Prometheus text format."""
+    response = PlainTextResponse(REGISTRY.exposition(), media_type="text/plain; version=0.0.4")
+    await response(scope, receive, send)
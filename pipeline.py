@@ -0,0 +1,329 @@
+"""HPO enrichment -> prompt -> GPT-4, shared by the Shiny app and batch mode."""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import namedtuple
+
+import metrics
+from cache import SingleFlight, TTLCache
+from hpo_client import HPO_API_URL, HPOClient, parse_hpo_matches
+from hpo_index import HPOIndex, STOPWORDS, tokenize
+from prompt_builder import HPOMatch, build_prompt, load_encoding
+from scheduler import RequestScheduler
+
+logger = logging.getLogger(__name__)
+
+# Model settings and the token budget for the user prompt. These are the
+# defaults; create_pipeline() reads overrides from the environment, so they
+# take effect however late .env is loaded.
+GPT4_MODEL = 'gpt-4'
+GPT4_MAX_TOKENS = 500  # Reduced max_tokens for faster response
+GPT4_TEMPERATURE = 0.7
+PROMPT_TOKEN_BUDGET = 2000
+
+# Streaming settings: partial output is pushed to the page as it arrives
+GPT4_STREAM = True
+GPT4_FIRST_TOKEN_TIMEOUT = 20  # Seconds to wait for the first chunk
+GPT4_IDLE_TIMEOUT = 10  # Seconds allowed between chunks
+STREAM_UPDATE_INTERVAL = 0.1  # Minimum seconds between UI updates while streaming
+
+# The finished result of one case report. timings holds seconds per stage
+# ("hpo", "prompt", "gpt4", and "time_to_first_token" when streamed); model
+# is the model that answered, which differs from the configured one when
+# the scheduler fell back.
+Diagnosis = namedtuple("Diagnosis", "text prompt_tokens completion_tokens timings cached model")
+
+
+def configure_logging(default_level):
+    """Set up logging at LOG_LEVEL (or default_level) for the app and batch mode.
+
+    The HTTP clients log every request URL, and HPO search URLs contain words
+    from the case report, so their loggers are kept at WARNING.
+    """
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', default_level),
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    for name in ('httpx', 'httpcore', 'openai'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+
+# Function to extract unique terms from the case report
+def extract_terms(case_report):
+    # Strip punctuation and skip stopwords so they don't each cost a remote search
+    terms = {word for word, _, _ in tokenize(case_report) if word not in STOPWORDS}  # Using set to get unique terms
+    return list(terms)
+
+
+class DiagnosisPipeline:
+    """Run a case report through HPO lookup, prompt assembly and GPT-4.
+
+    GPT-4 requests are admitted and retried by scheduler (a shared
+    RequestScheduler). response_cache, if given, stores finished
+    responses; identical runs in flight always share one call.
+    """
+
+    def __init__(self, client, hpo_client, hpo_index=None, model=GPT4_MODEL, max_tokens=GPT4_MAX_TOKENS,
+                 temperature=GPT4_TEMPERATURE, prompt_budget=PROMPT_TOKEN_BUDGET, stream=GPT4_STREAM,
+                 first_token_timeout=GPT4_FIRST_TOKEN_TIMEOUT, idle_timeout=GPT4_IDLE_TIMEOUT,
+                 request_timeout=30, response_cache=None, scheduler=None):
+        # Retries are the scheduler's job, so turn off the SDK's own
+        self.client = client.with_options(max_retries=0)
+        self.hpo_client = hpo_client
+        self.hpo_index = hpo_index
+        self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.prompt_budget = prompt_budget
+        self.stream = stream
+        self.first_token_timeout = first_token_timeout
+        self.idle_timeout = idle_timeout
+        self.request_timeout = request_timeout
+        self.response_cache = response_cache
+        self.scheduler = scheduler if scheduler is not None else RequestScheduler()
+        self._inflight = SingleFlight()
+
+    # Function to collect related HPO terms (as HPOMatch records) for the case report
+    async def lookup_hpo_terms(self, case_report):
+        if self.hpo_index is not None:
+            return [HPOMatch(annotation.hpo_id, annotation.label, annotation.text)
+                    for annotation in self.hpo_index.annotate(case_report)]
+
+        with metrics.span("extract_terms"):
+            terms = extract_terms(case_report)
+        metrics.hpo_lookups_per_request.observe(len(terms))
+        hpo_terms_info = []
+
+        # Look up all terms concurrently over the shared connection pool
+        hpo_responses = await self.hpo_client.search_many(terms)
+        for term in terms:
+            for hpo_id, label in parse_hpo_matches(hpo_responses[term]):
+                hpo_terms_info.append(HPOMatch(hpo_id, label, term))
+        return hpo_terms_info
+
+    def build_prompt(self, case_report, hpo_terms_info):
+        # Dedupe and rank the HPO terms, keeping the best ones that fit the token budget
+        return build_prompt(case_report, hpo_terms_info, model=self.model, max_tokens=self.max_tokens,
+                            budget=self.prompt_budget,
+                            depths=self.hpo_index.depths if self.hpo_index else None)
+
+    async def gpt4_request(self, refined_prompt, model=None, **kwargs):
+        model = model or self.model
+        raw = await self.client.chat.completions.with_raw_response.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": "You are a medical expert."},
+                {"role": "user", "content": refined_prompt}
+            ],
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+            top_p=1.0,
+            frequency_penalty=0.0,
+            presence_penalty=0.0,
+            **kwargs
+        )
+        # Slow down before the API starts answering with 429s
+        self.scheduler.observe(raw.headers, model)
+        return raw.parse()
+
+    async def call_gpt4_with_retry(self, refined_prompt, prompt_tokens=0, session_id=None):
+        """Returns (response, model that produced it)."""
+
+        async def request(model):
+            with metrics.span("gpt4_call"):
+                return await asyncio.wait_for(
+                    self.gpt4_request(refined_prompt, model=model),
+                    timeout=self.request_timeout
+                )
+
+        return await self.scheduler.run(request, self.model, tokens=prompt_tokens + self.max_tokens,
+                                        key=session_id)
+
+    async def stream_gpt4_with_retry(self, refined_prompt, on_text, prompt_tokens=0, session_id=None):
+        """Stream a completion, calling on_text with the text so far (throttled).
+
+        Returns (text, time_to_first_token, total_time, model). Only attempts
+        that fail before any text has arrived are retried.
+        """
+        chunks = []
+
+        async def request(model):
+            start = time.perf_counter()
+            stream = None
+            try:
+                stream = await asyncio.wait_for(self.gpt4_request(refined_prompt, model=model, stream=True),
+                                                timeout=self.first_token_timeout)
+                chunk_iter = stream.__aiter__()
+                time_to_first_token = None
+                last_update = 0.0
+                while True:
+                    if time_to_first_token is None:
+                        timeout = max(self.first_token_timeout - (time.perf_counter() - start), 0)
+                    else:
+                        timeout = self.idle_timeout
+                    try:
+                        chunk = await asyncio.wait_for(chunk_iter.__anext__(), timeout=timeout)
+                    except StopAsyncIteration:
+                        break
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if not delta:
+                        continue
+                    now = time.perf_counter()
+                    if time_to_first_token is None:
+                        time_to_first_token = now - start
+                        metrics.gpt4_time_to_first_token_seconds.observe(time_to_first_token)
+                    chunks.append(delta)
+                    if now - last_update >= STREAM_UPDATE_INTERVAL:
+                        await on_text("".join(chunks))
+                        last_update = now
+                text = "".join(chunks).strip()
+                await on_text(text)
+                return text, time_to_first_token, time.perf_counter() - start
+            finally:
+                metrics.stage_seconds.observe(time.perf_counter() - start, stage="gpt4_call")
+                if stream is not None:
+                    await stream.close()
+
+        (text, time_to_first_token, total_time), model = await self.scheduler.run(
+            request, self.model, tokens=prompt_tokens + self.max_tokens, key=session_id,
+            can_retry=lambda error: not chunks)
+        return text, time_to_first_token, total_time, model
+
+    async def generate(self, case_report, on_text=None, log=None, session_id=None):
+        """Run the full pipeline for one case report, bypassing the response cache.
+
+        Responses are streamed when streaming is enabled and on_text is given.
+        Progress messages are appended to log, if given. session_id groups
+        requests for fair scheduling.
+        """
+        log = log if log is not None else []
+        timings = {}
+
+        log.append("Submitting request to HPO API...")
+
+        with metrics.span("hpo") as hpo_span:
+            hpo_terms_info = await self.lookup_hpo_terms(case_report)
+        timings["hpo"] = hpo_span.elapsed
+        log.append("Received response from HPO API.")
+        logger.info("Received %d matches from HPO API in %.2fs.", len(hpo_terms_info), hpo_span.elapsed)
+
+        with metrics.span("prompt_build") as prompt_span:
+            prompt = self.build_prompt(case_report, hpo_terms_info)
+        timings["prompt"] = prompt_span.elapsed
+        metrics.prompt_tokens.observe(prompt.tokens)
+        metrics.prompt_tokens_saved_total.inc(max(prompt.baseline_tokens - prompt.tokens, 0))
+        logger.info("Prompt: %d tokens, %d/%d HPO terms, %d tokens saved", prompt.tokens, prompt.terms_kept,
+                    prompt.terms_total, prompt.baseline_tokens - prompt.tokens)
+
+        log.append("Submitting request to GPT-4...")
+
+        # Query GPT-4 with additional information
+        start = time.perf_counter()
+        completion_tokens = None
+        if self.stream and on_text is not None:
+            response_content, time_to_first_token, total_time, model = await self.stream_gpt4_with_retry(
+                prompt.text, on_text, prompt_tokens=prompt.tokens, session_id=session_id)
+            timings["time_to_first_token"] = time_to_first_token
+            logger.info("GPT-4 time to first token: %.2fs, total: %.2fs", time_to_first_token or 0, total_time)
+        else:
+            response, model = await self.call_gpt4_with_retry(prompt.text, prompt_tokens=prompt.tokens,
+                                                              session_id=session_id)
+            response_content = response.choices[0].message.content.strip()
+            if response.usage is not None:
+                completion_tokens = response.usage.completion_tokens
+        timings["gpt4"] = time.perf_counter() - start
+
+        log.append("Received response from GPT-4.")
+        logger.info("Received response from %s in %.2fs.", model, timings["gpt4"])
+        return Diagnosis(response_content, prompt.tokens, completion_tokens, timings, False, model)
+
+    def cache_key(self, case_report):
+        normalized = " ".join(case_report.split()).lower()
+        params = [normalized, self.model, self.max_tokens, self.temperature, self.prompt_budget,
+                  bool(self.hpo_index)]
+        return hashlib.sha256(json.dumps(params).encode()).hexdigest()
+
+    async def diagnose(self, case_report, on_text=None, log=None, session_id=None):
+        """Like generate(), but served from the response cache when possible.
+
+        Identical case reports in flight at the same time share one run, and
+        each caller's on_text receives its streamed output from then on.
+        """
+        key = self.cache_key(case_report)
+        if self.response_cache is not None:
+            response_content = self.response_cache.get(key)
+            if response_content is not None:
+                logger.info("Response cache hit.")
+                metrics.requests_total.inc(outcome="cached")
+                return Diagnosis(response_content, None, None, {}, True, self.model)
+        try:
+            with metrics.span("total"):
+                diagnosis = await self._inflight.do(
+                    key, lambda: self._generate_and_cache(key, case_report, log, session_id), subscriber=on_text)
+        except asyncio.TimeoutError:
+            metrics.requests_total.inc(outcome="timeout")
+            raise
+        except Exception:
+            metrics.requests_total.inc(outcome="error")
+            raise
+        metrics.requests_total.inc(outcome="ok")
+        return diagnosis
+
+    async def _generate_and_cache(self, key, case_report, log, session_id):
+        # Stream to whoever is waiting on this run, not just the caller that started it
+        async def on_text(text):
+            await self._inflight.publish(key, text)
+
+        diagnosis = await self.generate(case_report, on_text, log, session_id)
+        # Only cache answers from the configured model; the key doesn't record
+        # which model answered, and a fallback answer shouldn't outlive the rate limit
+        if self.response_cache is not None and diagnosis.model == self.model:
+            self.response_cache.set(key, diagnosis.text)
+        return diagnosis
+
+
+def create_pipeline(client, **kwargs):
+    """Build a pipeline configured from the environment (see README)."""
+    kwargs.setdefault('model', os.getenv('GPT4_MODEL', GPT4_MODEL))
+    kwargs.setdefault('prompt_budget', int(os.getenv('PROMPT_TOKEN_BUDGET', str(PROMPT_TOKEN_BUDGET))))
+    kwargs.setdefault('stream', os.getenv('GPT4_STREAM', '1') == '1')
+    kwargs.setdefault('first_token_timeout',
+                      float(os.getenv('GPT4_FIRST_TOKEN_TIMEOUT', str(GPT4_FIRST_TOKEN_TIMEOUT))))
+    kwargs.setdefault('idle_timeout', float(os.getenv('GPT4_IDLE_TIMEOUT', str(GPT4_IDLE_TIMEOUT))))
+
+    hpo_client = HPOClient(
+        api_url=os.getenv('HPO_API_URL', HPO_API_URL),
+        max_concurrency=int(os.getenv('HPO_MAX_CONCURRENCY', '8')),
+        timeout=float(os.getenv('HPO_TIMEOUT', '5')),
+        cache=TTLCache(
+            maxsize=int(os.getenv('HPO_CACHE_SIZE', '4096')),
+            ttl=float(os.getenv('HPO_CACHE_TTL', str(7 * 24 * 3600))),
+            path=os.getenv('HPO_CACHE_PATH') or None,  # e.g. hpo_cache.sqlite3 to keep the cache across restarts
+        ),
+    )
+
+    # Optional offline HPO index (see hpo_index.py); when present, the remote API is not used
+    hpo_index_path = os.getenv('HPO_INDEX_PATH')
+    hpo_index = HPOIndex.load(hpo_index_path) if hpo_index_path else None
+
+    # Finished responses, keyed on the normalized case report and the model/prompt settings
+    response_cache = TTLCache(
+        maxsize=int(os.getenv('RESPONSE_CACHE_SIZE', '256')),
+        ttl=float(os.getenv('RESPONSE_CACHE_TTL', str(24 * 3600))),
+        path=os.getenv('RESPONSE_CACHE_PATH') or None,
+    )
+    kwargs.setdefault('response_cache', response_cache)
+
+    # One scheduler for every GPT-4 request in this worker
+    kwargs.setdefault('scheduler', RequestScheduler(
+        max_concurrency=int(os.getenv('GPT4_MAX_CONCURRENCY', '4')),
+        requests_per_minute=float(os.getenv('GPT4_RPM', '0')) or None,
+        tokens_per_minute=float(os.getenv('GPT4_TPM', '0')) or None,
+        fallback_model=os.getenv('GPT4_FALLBACK_MODEL') or None,
+    ))
+    # Load the tokenizer now; it may need a (blocking) download on first use
+    load_encoding(kwargs['model'])
+    metrics.register_cache("hpo_cache", hpo_client.cache, "HPO search cache")
+    metrics.register_cache("response_cache", kwargs['response_cache'], "GPT-4 response cache")
+    return DiagnosisPipeline(client, hpo_client, hpo_index=hpo_index, **kwargs)
@@ -0,0 +1,147 @@
+"""Assemble the GPT-4 prompt within a token budget.
+
+HPO matches are deduplicated by ID and ranked by how relevant they look for
+the case text; the lowest-ranked ones are dropped first when the prompt
+would not fit.
+"""
+import logging
+from collections import namedtuple
+
+from hpo_index import normalize, tokenize
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - tiktoken is optional
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+PROMPT_TEMPLATE = (
+    "Given the following patient case report and related medical terms, list the potential "
+    "differential diagnoses and broad disease categories:\n\nCase Report:\n{case_report}\n\n"
+    "Related Medical Terms:\n{terms}"
+)
+
+# Context window sizes, in tokens
+MODEL_CONTEXT_TOKENS = {
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+    "gpt-3.5-turbo": 16385,
+}
+
+# Allowance for the system message and chat formatting around the prompt
+MESSAGE_OVERHEAD_TOKENS = 20
+
+# One HPO term the lookup produced: query is the case-report word or phrase that matched it
+HPOMatch = namedtuple("HPOMatch", "hpo_id label query")
+
+Prompt = namedtuple("Prompt", "text tokens baseline_tokens terms_kept terms_total")
+
+_encodings = {}
+
+
+def load_encoding(model):
+    """Load (once) and return the tiktoken encoding for model, or None to estimate instead.
+
+    tiktoken downloads its BPE file on first use with a blocking request, so
+    call this at startup rather than from the event loop.
+    """
+    if model not in _encodings:
+        encoding = None
+        if tiktoken is None:
+            logger.warning("tiktoken is not installed; estimating prompt tokens from text length.")
+        else:
+            try:
+                try:
+                    encoding = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception as e:
+                logger.warning("Could not load the tiktoken encoding for %s (%s); "
+                               "estimating prompt tokens from text length.", model, e)
+        _encodings[model] = encoding
+    return _encodings[model]
+
+
+def count_tokens(text, model="gpt-4"):
+    encoding = load_encoding(model)
+    if encoding is None:
+        return (len(text) + 3) // 4  # roughly four characters per token for English
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text, max_tokens, model="gpt-4"):
+    encoding = load_encoding(model)
+    if encoding is None:
+        return text[:max_tokens * 4]
+    tokens = encoding.encode(text, disallowed_special=())
+    return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+
+
+def prompt_budget(model, max_tokens, limit=None):
+    """Tokens available for the user prompt, capped at limit if given."""
+    budget = MODEL_CONTEXT_TOKENS.get(model, 8192) - max_tokens - MESSAGE_OVERHEAD_TOKENS
+    return budget if limit is None else min(budget, limit)
+
+
+def rank_matches(case_report, matches, depths=None):
+    """Deduplicate matches by HPO ID and return them most relevant first.
+
+    A term scores higher when more of its label's words occur in the case
+    report, when several case-report words led to it, when it was matched by
+    a multi-word phrase, and when it is deeper (more specific) in the ontology.
+    """
+    depths = depths or {}
+    case_words = {word for word, _, _ in tokenize(case_report)}
+    by_id = {}
+    for match in matches:
+        entry = by_id.setdefault(match.hpo_id, [match.label, set()])
+        entry[1].add(normalize(match.query))
+
+    scored = []
+    for hpo_id, (label, queries) in by_id.items():
+        label_words = normalize(label).split()
+        overlap = sum(word in case_words for word in label_words) / len(label_words) if label_words else 0
+        phrase_words = max(len(query.split()) for query in queries)
+        score = 4 * overlap + min(len(queries), 3) + 0.5 * (phrase_words - 1) + 0.1 * depths.get(hpo_id, 0)
+        scored.append((score, hpo_id, label))
+    # sorted() is stable, so equal scores keep lookup order
+    return [(hpo_id, label) for score, hpo_id, label in sorted(scored, key=lambda item: -item[0])]
+
+
+def build_prompt(case_report, matches, model="gpt-4", max_tokens=500, budget=None, depths=None):
+    """Build the prompt, keeping the best-ranked HPO terms that fit the token budget."""
+    budget = prompt_budget(model, max_tokens, budget)
+    ranked = rank_matches(case_report, matches, depths)
+    baseline_tokens = _baseline_tokens(case_report, matches, model)
+
+    # The case report is the most valuable context, so only cut it when it cannot fit on its own
+    fixed_tokens = count_tokens(PROMPT_TEMPLATE.format(case_report="", terms=""), model)
+    if fixed_tokens + count_tokens(case_report, model) > budget:
+        case_report = truncate_tokens(case_report, max(budget - fixed_tokens, 0), model)
+    used = fixed_tokens + count_tokens(case_report, model)
+
+    lines = []
+    for hpo_id, label in ranked:
+        line = f"{hpo_id} {label}"
+        # +1 for the newline separating terms
+        line_tokens = count_tokens(line, model) + 1
+        if used + line_tokens > budget:
+            continue
+        lines.append(line)
+        used += line_tokens
+
+    text = PROMPT_TEMPLATE.format(case_report=case_report, terms="\n".join(lines))
+    return Prompt(text, count_tokens(text, model), baseline_tokens, len(lines), len(ranked))
+
+
+def _baseline_tokens(case_report, matches, model):
+    # What the previous fixed slicing ([:500] terms, [:5000] characters) would have sent
+    flat = []
+    for match in matches:
+        flat.extend([match.hpo_id, match.label])
+    text = PROMPT_TEMPLATE.format(case_report=case_report[:5000], terms="\n".join(flat[:500]))
+    return count_tokens(text, model)
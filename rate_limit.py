@@ -0,0 +1,32 @@
+import time
+
+
+class TokenBucket:
+    """Refills at rate_per_minute, holding at most capacity (default: one minute's worth)."""
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.available = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, amount):
+        """Seconds until amount can be taken (a request larger than the bucket waits for a full one)."""
+        self._refill()
+        missing = min(amount, self.capacity) - self.available
+        return max(missing, 0) / self.rate
+
+    def take(self, amount):
+        self._refill()
+        self.available -= min(amount, self.capacity)
+
+    def sync(self, remaining):
+        """Lower the level to remaining, e.g. what the server says is left (it also counts other clients)."""
+        self._refill()
+        self.available = min(self.available, remaining)
+
@@ -0,0 +1,259 @@
+"""Process-wide scheduler for OpenAI chat completions.
+
+Every GPT-4 request in the worker goes through one RequestScheduler, which
+caps in-flight completions, applies client-side request and token budgets,
+serves sessions round-robin, and retries only errors that can succeed on a
+second try. A 429 pauses the whole queue for the time the API asks for, so
+sessions don't all retry at the same moment.
+"""
+import asyncio
+import datetime
+import email.utils
+import logging
+import random
+import re
+import time
+from collections import OrderedDict, deque
+
+import openai
+
+import metrics
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+    asyncio.TimeoutError,
+)
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def is_retryable(error):
+    if isinstance(error, openai.APIStatusError) and not isinstance(error, RETRYABLE_ERRORS):
+        # Covers 409 and other statuses the SDK has no class for
+        return error.status_code == 409 or error.status_code >= 500
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
+def parse_duration(value):
+    """Parse OpenAI reset headers such as "20ms", "1s" or "6m0s" into seconds."""
+    matches = _DURATION_RE.findall(value or "")
+    if not matches:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in matches)
+
+
+def _header_number(headers, name):
+    try:
+        return float(headers[name])
+    except (KeyError, ValueError):
+        return None
+
+
+def retry_after(error):
+    """Seconds the API asked us to wait before retrying, if it said."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    if "retry-after-ms" in headers:
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if "retry-after" in headers:
+        value = headers["retry-after"]
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            date = None  # Neither seconds nor an HTTP date, e.g. "soon"
+        if date is not None:
+            if date.tzinfo is None:
+                date = date.replace(tzinfo=datetime.timezone.utc)
+            return max(date.timestamp() - time.time(), 0)
+    # Otherwise wait for whichever limit ran out to reset
+    resets = []
+    for kind in ("requests", "tokens"):
+        if headers.get(f"x-ratelimit-remaining-{kind}") == "0":
+            resets.append(parse_duration(headers.get(f"x-ratelimit-reset-{kind}")))
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+
+class RequestScheduler:
+    """Admit chat-completion requests fairly and within rate limits.
+
+    fallback_model, if set, is used instead of the primary model while the
+    primary is paused by a 429, and for retries after one.
+    """
+
+    def __init__(self, max_concurrency=4, requests_per_minute=None, tokens_per_minute=None, max_retries=3,
+                 backoff=1.0, max_backoff=30.0, fallback_model=None):
+        self.max_concurrency = max_concurrency
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.fallback_model = fallback_model
+        self.in_flight = 0
+        # session key -> deque of (future, tokens); served round-robin
+        self._queues = OrderedDict()
+        self._paused_until = 0.0
+        self._wakeup = None
+
+    def pause(self, seconds):
+        """Hold back new requests to the primary model for the given time."""
+        self._hold(seconds)
+        metrics.gpt4_rate_limited_total.inc()
+
+    def _hold(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def observe(self, headers, model):
+        """Apply the x-ratelimit-* headers of a successful response from model.
+
+        The request and token buckets are lowered to what the API says is
+        left, and created from the x-ratelimit-limit-* headers if no
+        client-side budget was configured. When a limit has run out, the
+        primary model is held back until it resets, instead of waiting for
+        a 429.
+        """
+        if model is not None and model == self.fallback_model:
+            return  # the fallback model has limits of its own
+        for kind in ("requests", "tokens"):
+            limit = _header_number(headers, f"x-ratelimit-limit-{kind}")
+            remaining = _header_number(headers, f"x-ratelimit-remaining-{kind}")
+            bucket = getattr(self, kind)
+            if bucket is None and limit:
+                bucket = TokenBucket(limit)
+                setattr(self, kind, bucket)
+            if bucket is not None and remaining is not None:
+                bucket.sync(remaining)
+            if remaining == 0:
+                reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+                if reset:
+                    self._hold(reset)
+
+    def _budget_delay(self, tokens):
+        return max(self.requests.delay(1) if self.requests else 0,
+                   self.tokens.delay(tokens) if self.tokens else 0)
+
+    def _dispatch(self):
+        while self._queues and self.in_flight < self.max_concurrency:
+            key, queue = next(iter(self._queues.items()))
+            future, tokens = queue[0]
+            if future.cancelled():
+                self._pop(key, queue)
+                continue
+
+            paused = self._paused_until - time.monotonic()
+            use_fallback = paused > 0 and self.fallback_model is not None
+            delay = max(0 if use_fallback else paused, self._budget_delay(tokens))
+            if delay > 0:
+                self._wake_after(delay)
+                return
+
+            self._pop(key, queue)
+            if self.requests:
+                self.requests.take(1)
+            if self.tokens:
+                self.tokens.take(tokens)
+            self.in_flight += 1
+            future.set_result(use_fallback)
+
+    def _pop(self, key, queue):
+        queue.popleft()
+        # Move this session behind the others so no session can starve the rest
+        if queue:
+            self._queues.move_to_end(key)
+        else:
+            del self._queues[key]
+
+    def _wake_after(self, delay):
+        loop = asyncio.get_running_loop()
+        when = loop.time() + delay
+        if self._wakeup is not None and self._wakeup.when() <= when:
+            return
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+        self._wakeup = loop.call_at(when, self._on_wakeup)
+
+    def _on_wakeup(self):
+        self._wakeup = None
+        self._dispatch()
+
+    async def _acquire(self, key, tokens):
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(key, deque()).append((future, tokens))
+        self._dispatch()
+        try:
+            with metrics.span("gpt4_queue"):
+                return await future
+        except asyncio.CancelledError:
+            # If the slot was granted just as we were cancelled, hand it back
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+
+    def _release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _backoff_delay(self, attempt):
+        # Full jitter, so callers that failed together don't retry together
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    async def run(self, request, model, tokens=0, key=None, can_retry=None):
+        """Run request(model) once admitted, retrying retryable failures.
+
+        Returns (result, model used), which is the fallback model if the
+        primary was rate limited. tokens is the expected prompt + completion size, charged against the
+        tokens-per-minute budget. key identifies the caller (e.g. the Shiny
+        session) for fair queueing. can_retry(error), if given, can veto a
+        retry, e.g. once streamed output has reached the user.
+        """
+        use_fallback = False
+        for attempt in range(self.max_retries):
+            last_attempt = attempt == self.max_retries - 1
+            use_fallback = await self._acquire(key, tokens) or use_fallback
+            chosen = self.fallback_model if use_fallback else model
+            if use_fallback:
+                metrics.gpt4_fallback_total.inc()
+            try:
+                return await request(chosen), chosen
+            except Exception as e:
+                if last_attempt or not is_retryable(e) or (can_retry is not None and not can_retry(e)):
+                    if isinstance(e, asyncio.TimeoutError):
+                        metrics.gpt4_timeouts_total.inc()
+                    raise
+                error = e
+            finally:
+                self._release()
+
+            if isinstance(error, asyncio.TimeoutError):
+                metrics.gpt4_timeouts_total.inc()
+            metrics.gpt4_retries_total.inc(error=type(error).__name__)
+            delay = retry_after(error)
+            if isinstance(error, openai.RateLimitError):
+                # Pause the whole queue so everyone waits, not just this caller;
+                # the retry is admitted once the pause is over (or on the fallback model)
+                self.pause(delay if delay is not None else self._backoff_delay(attempt))
+                use_fallback = self.fallback_model is not None
+                logger.warning("Rate limited by the API; pausing requests to %s.", model)
+                continue
+            if delay is None:
+                delay = self._backoff_delay(attempt)
+            logger.warning("Error occurred: %r. Retrying in %.1f seconds...", error, delay)
+            with metrics.span("gpt4_retry_backoff"):
+                await asyncio.sleep(delay)